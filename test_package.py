@@ -1,9 +1,75 @@
 #!/usr/bin/env python3
 """Test script for video2mp4 package"""
 
-from video2mp4 import convert_video, check_ffmpeg, start_server
+from video2mp4 import convert_video, convert_video_sync, check_ffmpeg, start_server
+from video2mp4.core import _normalize_resolution, _parse_duration
+from video2mp4 import websocket_server
+from video2mp4.cli import plan_batch
+from video2mp4.websocket_server import UPLOAD_FRAME_HEADER, WebSocketServer, _parse_upload_frame
+import asyncio
+import json
+import os
+import stat
 import sys
 
+import pytest
+
+# Stand-in for ffmpeg: prints a header on stderr and three -progress blocks on stdout
+FAKE_FFMPEG = """#!/bin/sh
+echo "  Duration: 00:00:10.00, start: 0.000000, bitrate: 1000 kb/s" >&2
+echo "Stream mapping:" >&2
+for t in 2500000 5000000 10000000; do
+  printf "frame=1\\nfps=30.0\\nbitrate=100kbits/s\\nout_time_ms=$t\\nprogress=continue\\n"
+done
+"""
+
+class FakeWebSocket:
+    """Records the JSON messages the server sends to one connection"""
+    remote_address = ("127.0.0.1", 0)
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """A WebSocketServer whose uploads directory lives in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    return WebSocketServer(max_concurrent=1)
+
+async def start_upload(server, websocket, file_name, file_size):
+    """Initialize an upload and return its (upload_id, upload_slot)"""
+    await server.process_message(websocket, json.dumps({"action": "upload", "file_name": file_name, "file_size": file_size}))
+    init = websocket.sent[-1]
+    assert init["type"] == "upload_init"
+    return init["upload_id"], init["upload_slot"]
+
+async def wait_until(predicate, timeout=2.0):
+    """Yield to the event loop until predicate() holds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, "timed out waiting for the server"
+        await asyncio.sleep(0.01)
+
+@pytest.fixture
+def gated_conversions(monkeypatch):
+    """Replace the server's convert_video with one that finishes when the returned event is set"""
+    gate = {}
+
+    async def fake_convert_video(input_file, output_file, progress_callback=None, **kwargs):
+        await gate["event"].wait()
+        return True
+
+    monkeypatch.setattr(websocket_server, "convert_video", fake_convert_video)
+    return gate
+
+def convert_message(name):
+    """JSON convert request for name.avi -> name.mp4"""
+    return json.dumps({"action": "convert", "input_file": f"{name}.avi", "output_file": f"{name}.mp4"})
+
 def test_ffmpeg_check():
     """Test FFmpeg availability check"""
     print("测试FFmpeg检查...")
@@ -15,10 +81,187 @@ def test_api_import():
     """Test API import"""
     print("\n测试API导入...")
     print(f"convert_video 函数: {callable(convert_video)}")
+    print(f"convert_video_sync 函数: {callable(convert_video_sync)}")
     print(f"check_ffmpeg 函数: {callable(check_ffmpeg)}")
     print(f"start_server 函数: {callable(start_server)}")
     print("API导入测试通过!")
 
+@pytest.mark.skipif(sys.platform == "win32", reason="fake ffmpeg is a shell script")
+def test_progress_per_block(tmp_path, monkeypatch):
+    """Test one progress callback per FFmpeg -progress block"""
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(FAKE_FFMPEG)
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ.get("PATH", ""))
+    input_file = tmp_path / "input.avi"
+    input_file.write_bytes(b"")
+
+    updates = []
+    assert convert_video_sync(str(input_file), str(tmp_path / "output.mp4"), updates.append)
+    progress = [u for u in updates if u["status"] == "progress"]
+    assert [u["progress"] for u in progress] == [25, 50, 100]
+    assert all(u["duration"] == 10.0 and u["fps"] == "30.0" for u in progress)
+    assert updates[-1]["status"] == "completed"
+
+def test_parse_duration():
+    """Test parsing the Duration line of the FFmpeg header"""
+    assert _parse_duration("  Duration: 01:02:03.50, start: 0.000000, bitrate: 1000 kb/s") == 3723.5
+    assert _parse_duration("  Duration: N/A, start: 0.000000, bitrate: N/A") is None
+    assert _parse_duration("Stream mapping:") is None
+
+def test_normalize_resolution():
+    """Test resolution validation"""
+    assert _normalize_resolution("1920x1080") == "1920x1080"
+    assert _normalize_resolution(" 1280X720 ") == "1280x720"
+    assert _normalize_resolution(None) is None
+    assert _normalize_resolution("") is None
+    for bad in ("1920", "1920x", "x1080", "1920*1080", "1920x1080;rm"):
+        assert _normalize_resolution(bad) is None
+
+def test_invalid_resolution_rejected(tmp_path):
+    """Test a bad resolution fails before any filesystem work"""
+    output_file = tmp_path / "new_dir" / "output.mp4"
+    updates = []
+    assert not convert_video_sync(str(tmp_path / "missing.avi"), str(output_file), updates.append, resolution="1920x")
+    assert "Invalid resolution" in updates[-1]["message"]
+    assert not output_file.parent.exists()
+
+def test_parse_upload_frame():
+    """Test splitting binary upload frames"""
+    frame = UPLOAD_FRAME_HEADER.pack(3, 1 << 33) + b"data"
+    assert _parse_upload_frame(frame) == (3, 1 << 33, b"data")
+    assert _parse_upload_frame(UPLOAD_FRAME_HEADER.pack(1, 0)) == (1, 0, b"")
+    assert _parse_upload_frame(frame[:UPLOAD_FRAME_HEADER.size - 1]) is None
+
+def test_upload_rejects_bad_offset_and_other_connection(server, tmp_path):
+    """Test upload chunks must come in order from the connection that started the upload"""
+    async def run():
+        owner, other = FakeWebSocket(), FakeWebSocket()
+        upload_id, slot = await start_upload(server, owner, "clip.bin", 6)
+
+        await server.process_message(other, UPLOAD_FRAME_HEADER.pack(slot, 0) + b"xyz")
+        assert other.sent[-1]["type"] == "error"
+        await server.process_message(other, json.dumps({"action": "upload_chunk", "upload_id": upload_id, "chunk": "eHl6"}))
+        assert other.sent[-1]["type"] == "error"
+        await server.process_message(other, json.dumps({"action": "upload_complete", "upload_id": upload_id}))
+        assert other.sent[-1]["type"] == "error"
+
+        await server.process_message(owner, UPLOAD_FRAME_HEADER.pack(slot, 3) + b"def")
+        assert "Unexpected upload offset" in owner.sent[-1]["message"]
+        await server.process_message(owner, UPLOAD_FRAME_HEADER.pack(slot, 0) + b"abc")
+        await server.process_message(owner, UPLOAD_FRAME_HEADER.pack(slot, 0) + b"abc")
+        assert "Unexpected upload offset" in owner.sent[-1]["message"]
+        await server.process_message(owner, UPLOAD_FRAME_HEADER.pack(slot, 3) + b"def")
+        await server.process_message(owner, json.dumps({"action": "upload_complete", "upload_id": upload_id}))
+        assert owner.sent[-1]["type"] == "upload_complete"
+
+    asyncio.run(run())
+    assert (tmp_path / "uploads" / "clip.bin").read_bytes() == b"abcdef"
+
+def test_upload_writer_coalesces_and_flushes(server, tmp_path, monkeypatch):
+    """Test chunks are written in buffer-sized batches and flushed on upload_complete"""
+    monkeypatch.setattr(websocket_server, "UPLOAD_WRITE_BUFFER", 4)
+
+    async def run():
+        websocket = FakeWebSocket()
+        upload_id, slot = await start_upload(server, websocket, "clip.bin", 8)
+        state = server.uploads[upload_id]
+
+        await server.process_message(websocket, UPLOAD_FRAME_HEADER.pack(slot, 0) + b"abc")
+        assert websocket.sent[-1]["uploaded"] == 3
+        await asyncio.sleep(0.05)
+        assert state["uploaded_size"] == 0  # still buffered
+
+        await server.process_message(websocket, UPLOAD_FRAME_HEADER.pack(slot, 3) + b"def")
+        await wait_until(lambda: state["uploaded_size"] == 6)
+
+        await server.process_message(websocket, UPLOAD_FRAME_HEADER.pack(slot, 6) + b"gh")
+        assert websocket.sent[-1]["progress"] == 100
+        await asyncio.sleep(0.05)
+        assert state["uploaded_size"] == 6
+
+        await server.process_message(websocket, json.dumps({"action": "upload_complete", "upload_id": upload_id}))
+        assert websocket.sent[-1]["type"] == "upload_complete"
+        assert state["uploaded_size"] == 8
+        assert upload_id not in server.uploads
+
+    asyncio.run(run())
+    assert (tmp_path / "uploads" / "clip.bin").read_bytes() == b"abcdefgh"
+
+def test_convert_queued_notice(server, gated_conversions):
+    """Test requests beyond max_concurrent are told they are queued"""
+    async def run():
+        gated_conversions["event"] = asyncio.Event()
+        websocket = FakeWebSocket()
+        await server.process_message(websocket, convert_message("first"))
+        await server.process_message(websocket, convert_message("second"))
+        assert [m["type"] for m in websocket.sent] == ["task_started", "task_started", "queued"]
+        assert websocket.sent[2]["task_id"] == websocket.sent[1]["task_id"]
+        gated_conversions["event"].set()
+        await asyncio.gather(*(state["task"] for state in server.tasks.values()))
+
+    asyncio.run(run())
+
+def test_finished_tasks_removed(server, gated_conversions):
+    """Test finished conversions are dropped from the task table"""
+    async def run():
+        gated_conversions["event"] = asyncio.Event()
+        websocket = FakeWebSocket()
+        for name in ("first", "second"):
+            await server.process_message(websocket, convert_message(name))
+        tasks = [state["task"] for state in server.tasks.values()]
+        assert len(tasks) == 2
+        gated_conversions["event"].set()
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(0)
+        assert server.tasks == {}
+
+    asyncio.run(run())
+
+def test_cancel_requires_task_owner(server, gated_conversions):
+    """Test a connection can only cancel conversions it started"""
+    async def run():
+        gated_conversions["event"] = asyncio.Event()
+        owner, other = FakeWebSocket(), FakeWebSocket()
+        await server.process_message(owner, convert_message("clip"))
+        task_id = owner.sent[0]["task_id"]
+        task = server.tasks[task_id]["task"]
+
+        await server.process_message(other, json.dumps({"action": "cancel", "task_id": task_id}))
+        assert other.sent[-1]["type"] == "error"
+        await asyncio.sleep(0)
+        assert not task.cancelled()
+
+        await server.process_message(owner, json.dumps({"action": "cancel", "task_id": task_id}))
+        assert owner.sent[-1]["type"] == "task_cancelled"
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+
+def test_plan_batch_collisions(tmp_path):
+    """Test batch outputs never collide with each other or overwrite an input"""
+    inputs = [str(tmp_path / name) for name in ("a.avi", "a.mkv", "a.mp4", "b.avi")]
+    conversions, skipped = plan_batch(inputs, str(tmp_path))
+    assert conversions == [
+        (inputs[0], str(tmp_path / "a_avi.mp4")),
+        (inputs[1], str(tmp_path / "a_mkv.mp4")),
+        (inputs[3], str(tmp_path / "b.mp4")),
+    ]
+    assert [input_file for input_file, _ in skipped] == [inputs[2]]
+
+    conversions, skipped = plan_batch(inputs, str(tmp_path / "out"))
+    outputs = [output for _, output in conversions]
+    assert outputs == [str(tmp_path / "out" / name) for name in ("a.mp4", "a_mkv.mp4", "a_mp4.mp4", "b.mp4")]
+    assert skipped == []
+
+def test_plan_batch_skips_unplaceable(tmp_path):
+    """Test an input is skipped when both candidate outputs are taken"""
+    inputs = [str(tmp_path / name) for name in ("a.mp4", "a_avi.mp4", "a.avi")]
+    conversions, skipped = plan_batch(inputs, str(tmp_path))
+    assert conversions == []
+    assert [input_file for input_file, _ in skipped] == inputs
+
 def main():
     """Main test function"""
     print("测试 video2mp4 包...")
@@ -4,13 +4,17 @@ __version__ = "0.1.0"
 __author__ = "Video Converter Team"
 __description__ = "Convert various video formats to MP4 with WebSocket progress updates"
 
-from .core import convert_video, check_ffmpeg
+from .core import convert_video, convert_video_sync, check_ffmpeg, get_ffmpeg_version, get_video_duration, detect_hw_encoder
 from .websocket_server import start_server
 from .cli import main
 
 __all__ = [
     "convert_video",
+    "convert_video_sync",
     "check_ffmpeg",
+    "get_ffmpeg_version",
+    "get_video_duration",
+    "detect_hw_encoder",
     "start_server",
     "main"
 ]
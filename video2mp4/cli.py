@@ -1,10 +1,17 @@
 """Command line interface for video conversion"""
 
 import argparse
+import asyncio
 import sys
 import os
-from typing import Optional
-from .core import convert_video, check_ffmpeg
+from typing import Callable, Dict, List, Tuple
+from .core import convert_video, convert_video_sync, check_ffmpeg, get_ffmpeg_version
+
+# File extensions picked up by --batch
+VIDEO_EXTENSIONS = {
+    ".3gp", ".avi", ".flv", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4",
+    ".mpeg", ".mpg", ".mts", ".ogv", ".ts", ".vob", ".webm", ".wmv"
+}
 
 
 def parse_args() -> argparse.Namespace:
@@ -15,7 +22,7 @@ def parse_args() -> argparse.Namespace:
     
 
     
-    # Required arguments (only required if not using --check-ffmpeg)
+    # Required arguments (only required if not using --check-ffmpeg or --batch)
     parser.add_argument(
         "input_file",
         nargs="?",
@@ -31,13 +38,13 @@ def parse_args() -> argparse.Namespace:
     # Conversion options
     parser.add_argument(
         "--codec",
-        default="libx264",
+        default=None,
         help="Video codec (default: libx264)"
     )
     
     parser.add_argument(
         "--preset",
-        default="medium",
+        default=None,
         choices=["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow", "placebo"],
         help="Encoding preset (default: medium)"
     )
@@ -66,6 +73,32 @@ def parse_args() -> argparse.Namespace:
         help="Video resolution (e.g., 1920x1080)"
     )
     
+    parser.add_argument(
+        "--hwaccel",
+        default="none",
+        choices=["none", "auto", "nvenc", "qsv", "vaapi"],
+        help="Hardware encoder to use; auto picks the first one FFmpeg supports (default: none)"
+    )
+    
+    # Batch conversion
+    parser.add_argument(
+        "--batch",
+        metavar="DIR",
+        help="Convert every video file in DIR instead of a single input_file"
+    )
+    
+    parser.add_argument(
+        "--output-dir",
+        help="Output directory for --batch (default: the batch directory)"
+    )
+    
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, (os.cpu_count() or 2) // 2),
+        help="Number of concurrent conversions for --batch (default: half the CPU count)"
+    )
+    
     # Utility commands
     parser.add_argument(
         "--check-ffmpeg",
@@ -76,19 +109,144 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def progress_callback(update: dict):
-    """Callback for progress updates in CLI"""
-    status = update.get("status")
+def make_progress_callback() -> Callable[[dict], None]:
+    """Create a CLI progress callback that redraws only when the percentage changes"""
+    last_progress = -1
+
+    def progress_callback(update: dict):
+        """Callback for progress updates in CLI"""
+        nonlocal last_progress
+        status = update.get("status")
+        
+        if status == "progress":
+            progress = update.get("progress", 0)
+            if progress != last_progress:
+                last_progress = progress
+                sys.stdout.write(f"\rProgress: {progress}% ")
+                sys.stdout.flush()
+        elif status == "completed":
+            print("\nConversion completed successfully!")
+            print(f"Output file: {update.get('output')}")
+        elif status == "warning":
+            print(f"\nWarning: {update.get('message')}")
+        elif status == "error":
+            print(f"\nError: {update.get('message')}")
+
+    return progress_callback
+
+
+def build_options(args: argparse.Namespace) -> Dict:
+    """Build conversion options from parsed arguments"""
+    options = {
+        "codec": args.codec,
+        "preset": args.preset,
+        "crf": args.crf,
+        "audio_codec": args.audio_codec,
+        "audio_bitrate": args.audio_bitrate,
+        "resolution": args.resolution,
+        "hwaccel": args.hwaccel
+    }
+    
+    # Remove None values
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def find_videos(directory: str) -> List[str]:
+    """List video files directly inside a directory, sorted by name"""
+    with os.scandir(directory) as entries:
+        return sorted(
+            entry.path for entry in entries
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS
+        )
+
+
+def plan_batch(input_files: List[str], output_dir: str) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """
+    Assign each input a unique output path
+
+    Returns (conversions, skipped): (input, output) pairs to convert and
+    (input, reason) pairs for files that can't be converted safely. An output
+    never overwrites any input, and no two inputs share an output; a
+    collision falls back to "<name>_<ext>.mp4" before giving up.
+    """
+    def key(path: str) -> str:
+        return os.path.normcase(os.path.abspath(path))
+
+    taken = {key(input_file) for input_file in input_files}
+    conversions = []
+    skipped = []
+    for input_file in input_files:
+        base_name, ext = os.path.splitext(os.path.basename(input_file))
+        output_file = os.path.join(output_dir, f"{base_name}.mp4")
+        if key(output_file) == key(input_file):
+            skipped.append((input_file, "output would overwrite the input"))
+            continue
+        if key(output_file) in taken:
+            output_file = os.path.join(output_dir, f"{base_name}_{ext[1:].lower()}.mp4")
+        if key(output_file) in taken:
+            skipped.append((input_file, f"output {output_file} would overwrite another file in the batch"))
+            continue
+        taken.add(key(output_file))
+        conversions.append((input_file, output_file))
+    return conversions, skipped
+
+
+async def convert_batch(conversions: List[Tuple[str, str]], options: Dict, jobs: int) -> int:
+    """Convert (input, output) pairs concurrently, at most `jobs` at a time; return the number of failures"""
+    sem = asyncio.Semaphore(max(1, jobs))
+
+    async def convert_one(input_file: str, output_file: str) -> bool:
+        def progress_callback(update: dict):
+            status = update.get("status")
+            if status == "completed":
+                print(f"✓ {input_file} -> {update.get('output')}")
+            elif status == "warning":
+                print(f"! {input_file}: {update.get('message')}")
+            elif status == "error":
+                print(f"✗ {input_file}: {update.get('message')}")
+
+        async with sem:
+            print(f"Converting {input_file}...")
+            return await convert_video(input_file, output_file, progress_callback, **options)
+
+    results = await asyncio.gather(*(convert_one(*conversion) for conversion in conversions))
+    return results.count(False)
+
+
+def run_batch(args: argparse.Namespace) -> int:
+    """Run a --batch conversion of a directory"""
+    if not os.path.isdir(args.batch):
+        print(f"Error: Batch directory '{args.batch}' does not exist")
+        return 1
+    
+    input_files = find_videos(args.batch)
+    if not input_files:
+        print(f"Error: No video files found in '{args.batch}'")
+        return 1
+    
+    # Check FFmpeg before conversion
+    if not check_ffmpeg():
+        print("Error: FFmpeg is not installed or not in PATH")
+        print("Please install FFmpeg and add it to your system PATH")
+        return 1
+    
+    output_dir = args.output_dir or args.batch
+    options = build_options(args)
+    conversions, skipped = plan_batch(input_files, output_dir)
+    
+    for input_file, reason in skipped:
+        print(f"Skipping {input_file}: {reason}")
+    
+    print(f"Converting {len(conversions)} files from {args.batch} to {output_dir} ({args.jobs} at a time)...")
+    print(f"Options: {options}")
+    
+    failures = asyncio.run(convert_batch(conversions, options, args.jobs))
+    summary = f"{len(conversions) - failures} of {len(conversions)} conversions succeeded"
+    if skipped:
+        summary += f", {len(skipped)} files skipped"
+    print(summary)
     
-    if status == "progress":
-        progress = update.get("progress", 0)
-        sys.stdout.write(f"\rProgress: {progress}% ")
-        sys.stdout.flush()
-    elif status == "completed":
-        print("\nConversion completed successfully!")
-        print(f"Output file: {update.get('output')}")
-    elif status == "error":
-        print(f"\nError: {update.get('message')}")
+    return 1 if failures else 0
 
 
 def main() -> int:
@@ -100,12 +258,19 @@ def main() -> int:
         is_available = check_ffmpeg()
         if is_available:
             print("✓ FFmpeg is installed and accessible")
+            version = get_ffmpeg_version()
+            if version:
+                print(version)
             return 0
         else:
             print("✗ FFmpeg is not installed or not in PATH")
             print("Please install FFmpeg and add it to your system PATH")
             return 1
     
+    # Convert a whole directory
+    if args.batch:
+        return run_batch(args)
+    
     # Validate input file
     if not args.input_file:
         print("Error: input_file is required")
@@ -127,26 +292,16 @@ def main() -> int:
         return 1
     
     # Build conversion options
-    options = {
-        "codec": args.codec,
-        "preset": args.preset,
-        "crf": args.crf,
-        "audio_codec": args.audio_codec,
-        "audio_bitrate": args.audio_bitrate,
-        "resolution": args.resolution
-    }
-    
-    # Remove None values
-    options = {k: v for k, v in options.items() if v is not None}
+    options = build_options(args)
     
     print(f"Converting {args.input_file} to {args.output_file}...")
     print(f"Options: {options}")
     
     # Run conversion
-    success = convert_video(
+    success = convert_video_sync(
         args.input_file,
         args.output_file,
-        progress_callback=progress_callback,
+        progress_callback=make_progress_callback(),
         **options
     )
     
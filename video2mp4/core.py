@@ -1,14 +1,44 @@
 """Core video conversion functionality"""
 
 import os
+import re
+import shutil
 import subprocess
 import json
 import asyncio
-from typing import Dict, Optional, Callable
+from collections import deque
+from functools import lru_cache
+from typing import Deque, Dict, Optional, Callable
+
+# Input duration as printed in FFmpeg's stream header, e.g. "Duration: 00:01:02.50"
+_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+# Only the tail of FFmpeg's stderr is kept; the last few lines form the error message
+STDERR_BUFFER_LINES = 100
+STDERR_ERROR_LINES = 10
+
+# Accepted resolution values, e.g. "1920x1080"
+_RES_RE = re.compile(r"^\d{2,5}x\d{2,5}$")
+
+# Hardware H.264 encoders, in order of preference for hwaccel="auto"
+HW_ENCODERS = {
+    "nvenc": "h264_nvenc",
+    "qsv": "h264_qsv",
+    "vaapi": "h264_vaapi",
+}
+
+# Render node used for VAAPI encoding
+VAAPI_DEVICE = "/dev/dri/renderD128"
 
 
 def check_ffmpeg() -> bool:
     """Check if FFmpeg is installed and accessible"""
+    return shutil.which("ffmpeg") is not None
+
+
+@lru_cache(maxsize=1)
+def get_ffmpeg_version() -> Optional[str]:
+    """Get the first line of `ffmpeg -version` output, cached for the process"""
     try:
         result = subprocess.run(
             ["ffmpeg", "-version"],
@@ -16,13 +46,60 @@ def check_ffmpeg() -> bool:
             text=True,
             check=True
         )
-        return "ffmpeg version" in result.stdout
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return None
+    first_line = result.stdout.partition("\n")[0].strip()
+    return first_line if first_line.startswith("ffmpeg version") else None
+
+
+def _hw_encoder_works(name: str) -> bool:
+    """Run a one-frame test encode to check the host can actually use an encoder"""
+    device_args = ["-vaapi_device", VAAPI_DEVICE] if name == "vaapi" else []
+    filter_args = ["-vf", "format=nv12,hwupload"] if name == "vaapi" else []
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        *device_args,
+        "-f", "lavfi",
+        "-i", "nullsrc=s=256x256",
+        "-frames:v", "1",
+        *filter_args,
+        "-c:v", HW_ENCODERS[name],
+        "-f", "null", "-"
+    ]
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=15)
     except (subprocess.SubprocessError, FileNotFoundError):
         return False
+    return True
 
 
-def get_video_duration(input_file: str) -> float:
-    """Get video duration using FFprobe"""
+@lru_cache(maxsize=1)
+def detect_hw_encoder() -> Optional[str]:
+    """Return the preferred hardware encoder that FFmpeg has and this host can run, if any"""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return None
+
+    # Encoder lines look like " V....D h264_nvenc  NVIDIA NVENC H.264 encoder"
+    available = {fields[1] for fields in map(str.split, result.stdout.splitlines()) if len(fields) > 1}
+    # Builds often include encoders for hardware that isn't present, so test each one
+    for name, encoder in HW_ENCODERS.items():
+        if encoder in available and _hw_encoder_works(name):
+            return name
+    return None
+
+
+@lru_cache(maxsize=128)
+def _probe_duration(input_file: str, size: int, mtime: float) -> float:
+    """Run FFprobe for a duration; size and mtime only key the cache"""
     try:
         cmd = [
             "ffprobe",
@@ -43,7 +120,54 @@ def get_video_duration(input_file: str) -> float:
         return 0.0
 
 
-def convert_video(
+def get_video_duration(input_file: str) -> float:
+    """Get video duration using FFprobe, cached until the file changes"""
+    try:
+        st = os.stat(input_file)
+    except OSError:
+        return 0.0
+    return _probe_duration(input_file, st.st_size, st.st_mtime)
+
+
+def _normalize_resolution(resolution) -> Optional[str]:
+    """Return a resolution as lowercase "WIDTHxHEIGHT", or None if it is empty or malformed"""
+    if not resolution:
+        return None
+    resolution = str(resolution).strip().lower()
+    return resolution if _RES_RE.match(resolution) else None
+
+
+def _parse_duration(line: str) -> Optional[float]:
+    """Parse seconds from an FFmpeg "Duration: HH:MM:SS.ss" line; None if absent or N/A"""
+    match = _DURATION_RE.search(line)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+async def _read_stderr(stream: asyncio.StreamReader, lines: Deque[str], header: Dict, header_done: asyncio.Event) -> None:
+    """Drain FFmpeg stderr, picking the input duration out of the header
+
+    header_done is set once the header has been read, or stderr closes first.
+    """
+    try:
+        async for raw in stream:
+            line = raw.decode(errors="replace").rstrip()
+            if not header_done.is_set():
+                if "duration" not in header:
+                    duration = _parse_duration(line)
+                    if duration is not None:
+                        header["duration"] = duration
+                # The stream mapping is printed once the input header is done
+                if line.startswith("Stream mapping:"):
+                    header_done.set()
+            lines.append(line)
+    finally:
+        header_done.set()
+
+
+async def convert_video(
     input_file: str,
     output_file: str,
     progress_callback: Optional[Callable[[Dict], None]] = None,
@@ -55,7 +179,7 @@ def convert_video(
     Args:
         input_file: Path to input video file
         output_file: Path to output MP4 file
-        progress_callback: Callback function for progress updates
+        progress_callback: Callback function (plain or coroutine) for progress updates
         **kwargs: Additional conversion parameters
             - codec: Video codec (default: libx264)
             - preset: Encoding preset (default: medium)
@@ -63,50 +187,49 @@ def convert_video(
             - audio_codec: Audio codec (default: aac)
             - audio_bitrate: Audio bitrate (default: 128k)
             - resolution: Video resolution (e.g., "1920x1080")
+            - hwaccel: Hardware encoder: "nvenc", "qsv", "vaapi", "auto" or "none" (default: none)
     """
-    """Handle both sync and async progress callbacks"""
-    original_callback = progress_callback
-    
-    def call_callback(update):
-        if original_callback:
-            try:
-                # Check if it's a coroutine function
-                if hasattr(original_callback, '__call__') and asyncio.iscoroutinefunction(original_callback):
-                    asyncio.run(original_callback(update))
-                else:
-                    original_callback(update)
-            except Exception as e:
-                print(f"Error calling progress callback: {e}")
-    
-    # Replace progress_callback with our wrapper
-    progress_callback = call_callback
+    # Normalize plain callbacks so every call site can simply await
+    if progress_callback and not asyncio.iscoroutinefunction(progress_callback):
+        sync_callback = progress_callback
+
+        async def progress_callback(update: Dict):
+            sync_callback(update)
+
     # Validate inputs
     if not input_file:
         if progress_callback:
-            progress_callback({"status": "error", "message": "Input file path is required"})
+            await progress_callback({"status": "error", "message": "Input file path is required"})
         return False
     
     if not output_file:
         if progress_callback:
-            progress_callback({"status": "error", "message": "Output file path is required"})
+            await progress_callback({"status": "error", "message": "Output file path is required"})
+        return False
+    
+    # Reject malformed resolutions before touching FFmpeg or the filesystem
+    resolution = kwargs.get("resolution")
+    if resolution and not _normalize_resolution(resolution):
+        if progress_callback:
+            await progress_callback({"status": "error", "message": f"Invalid resolution: {resolution} (expected WIDTHxHEIGHT, e.g. 1920x1080)"})
         return False
     
     # Check FFmpeg availability
     if not check_ffmpeg():
         if progress_callback:
-            progress_callback({"status": "error", "message": "FFmpeg not found. Please install FFmpeg and add it to system PATH"})
+            await progress_callback({"status": "error", "message": "FFmpeg not found. Please install FFmpeg and add it to system PATH"})
         return False
 
     # Check input file existence
     if not os.path.exists(input_file):
         if progress_callback:
-            progress_callback({"status": "error", "message": f"Input file not found: {input_file}"})
+            await progress_callback({"status": "error", "message": f"Input file not found: {input_file}"})
         return False
     
     # Check input file is a regular file
     if not os.path.isfile(input_file):
         if progress_callback:
-            progress_callback({"status": "error", "message": f"Input path is not a file: {input_file}"})
+            await progress_callback({"status": "error", "message": f"Input path is not a file: {input_file}"})
         return False
     
     # Create output directory if it doesn't exist
@@ -116,7 +239,7 @@ def convert_video(
             os.makedirs(output_dir, exist_ok=True)
         except Exception as e:
             if progress_callback:
-                progress_callback({"status": "error", "message": f"Failed to create output directory: {str(e)}"})
+                await progress_callback({"status": "error", "message": f"Failed to create output directory: {str(e)}"})
             return False
     
     # Ensure output file is in current directory for HTTP access
@@ -129,76 +252,180 @@ def convert_video(
     crf = kwargs.get("crf", "23")
     audio_codec = kwargs.get("audio_codec", "aac")
     audio_bitrate = kwargs.get("audio_bitrate", "128k")
-    resolution = kwargs.get("resolution")
+    resolution = _normalize_resolution(kwargs.get("resolution"))
+    hwaccel = kwargs.get("hwaccel")
+
+    if hwaccel == "auto":
+        # The first detection runs FFmpeg test encodes; keep them off the event loop
+        loop = asyncio.get_running_loop()
+        hwaccel = await loop.run_in_executor(None, detect_hw_encoder)
+    elif hwaccel == "none":
+        hwaccel = None
+    if hwaccel and hwaccel not in HW_ENCODERS:
+        if progress_callback:
+            await progress_callback({"status": "error", "message": f"Unsupported hwaccel: {hwaccel}"})
+        return False
+
+    # Hardware paths pick their own encoder and preset
+    if hwaccel and progress_callback:
+        ignored = [name for name in ("codec", "preset") if kwargs.get(name) is not None]
+        if ignored:
+            await progress_callback({
+                "status": "warning",
+                "message": f"Ignoring {', '.join(ignored)} with hwaccel {hwaccel}; using {HW_ENCODERS[hwaccel]}"
+            })
+
+    # Select encoder; hardware paths keep decoded frames on the device where possible
+    input_args = []
+    filters = []
+    if hwaccel == "nvenc":
+        # scale_cuda only takes GPU frames, but FFmpeg falls back to software
+        # decoding for inputs NVDEC can't handle; scale in system memory then
+        if resolution:
+            input_args = ["-hwaccel", "cuda"]
+            filters.append(f"scale={resolution}")
+        else:
+            input_args = ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+        video_args = ["-c:v", HW_ENCODERS[hwaccel], "-preset", "p4", "-cq", str(crf)]
+    elif hwaccel == "qsv":
+        if resolution:
+            filters.append(f"scale={resolution}")
+        video_args = ["-c:v", HW_ENCODERS[hwaccel], "-preset", "medium", "-global_quality", str(crf)]
+    elif hwaccel == "vaapi":
+        input_args = ["-vaapi_device", VAAPI_DEVICE]
+        if resolution:
+            filters.append(f"scale={resolution}")
+        filters.extend(["format=nv12", "hwupload"])
+        video_args = ["-c:v", HW_ENCODERS[hwaccel], "-qp", str(crf)]
+    else:
+        if resolution:
+            filters.append(f"scale={resolution}")
+        video_args = ["-c:v", codec, "-preset", preset, "-crf", str(crf), "-threads", "0"]
 
     # Build FFmpeg command
     cmd = [
         "ffmpeg",
+        "-fflags", "+genpts",  # Regenerate missing timestamps from odd containers
+        *input_args,
         "-i", input_file,
-        "-c:v", codec,
-        "-preset", preset,
-        "-crf", str(crf),
+        *video_args,
         "-c:a", audio_codec,
         "-b:a", audio_bitrate,
         "-y",  # Overwrite output file
         "-progress", "pipe:1",  # Output progress to stdout
         "-hide_banner",
-        "-loglevel", "error"
+        "-nostats",
+        "-loglevel", "info"  # Needed for the Duration line in the input header
     ]
 
-    # Add resolution if specified
-    if resolution:
-        cmd.extend(["-vf", f"scale={resolution}"])
+    # Add video filters (scaling, hardware upload) if any
+    if filters:
+        cmd.extend(["-vf", ",".join(filters)])
 
+    # Put the moov atom up front so the MP4 is seekable while streaming
+    cmd.extend(["-movflags", "+faststart"])
     cmd.append(output_file)
 
-    # Get video duration for progress calculation
-    duration = get_video_duration(input_file)
-
+    process = None
+    stderr_task = None
     try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        # No stdin: concurrent batch jobs would otherwise all read the
+        # terminal for FFmpeg's interactive keys
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
 
-        # Process progress output
-        for line in process.stdout:
-            line = line.strip()
-            if line.startswith("out_time_ms="):
-                try:
-                    time_ms = int(line.split("=")[1])
-                    time_sec = time_ms / 1000000
-                    if duration > 0:
-                        progress = min(100, int((time_sec / duration) * 100))
-                    else:
-                        progress = 0
-                    
-                    if progress_callback:
-                        progress_callback({
-                            "status": "progress",
-                            "progress": progress,
-                            "time": time_sec,
-                            "duration": duration
-                        })
-                except ValueError:
-                    pass
+        # Read stderr alongside stdout so neither pipe can fill up and stall
+        # FFmpeg; its header carries the duration
+        stderr_lines: Deque[str] = deque(maxlen=STDERR_BUFFER_LINES)
+        header: Dict = {}
+        header_done = asyncio.Event()
+        stderr_task = asyncio.create_task(_read_stderr(process.stderr, stderr_lines, header, header_done))
+
+        # Process progress output: FFmpeg emits a block of key=value lines
+        # terminated by "progress=continue" or "progress=end"
+        fields = {}
+        async for raw in process.stdout:
+            key, _, value = raw.decode().strip().partition("=")
+            fields[key] = value
+            if key != "progress":
+                continue
+
+            try:
+                time_sec = int(fields.get("out_time_ms", "0")) / 1_000_000
+            except ValueError:
+                time_sec = 0.0
+            # stdout and stderr are separate pipes, so the first progress
+            # block can arrive before the header has been read
+            await header_done.wait()
+            duration = header.get("duration")
+            if duration is None:
+                # No usable Duration line (e.g. "Duration: N/A"); ask FFprobe once
+                loop = asyncio.get_running_loop()
+                duration = await loop.run_in_executor(None, get_video_duration, input_file)
+                header["duration"] = duration
+            duration = duration or 0.0
+            if duration > 0:
+                progress = min(100, int((time_sec / duration) * 100))
+            else:
+                progress = 0
+
+            if progress_callback:
+                await progress_callback({
+                    "status": "progress",
+                    "progress": progress,
+                    "time": time_sec,
+                    "duration": duration,
+                    "fps": fields.get("fps"),
+                    "bitrate": fields.get("bitrate")
+                })
+            fields.clear()
 
         # Wait for process to complete
-        stdout, stderr = process.communicate()
-        returncode = process.returncode
+        await stderr_task
+        returncode = await process.wait()
 
         if returncode == 0:
             if progress_callback:
-                progress_callback({"status": "completed", "output": output_file})
+                await progress_callback({"status": "completed", "output": output_file})
             return True
         else:
             if progress_callback:
-                progress_callback({"status": "error", "message": stderr})
+                await progress_callback({"status": "error", "message": "\n".join(list(stderr_lines)[-STDERR_ERROR_LINES:])})
             return False
 
+    except asyncio.CancelledError:
+        # CancelledError subclasses Exception before Python 3.8
+        raise
     except Exception as e:
         if progress_callback:
-            progress_callback({"status": "error", "message": str(e)})
+            await progress_callback({"status": "error", "message": str(e)})
         return False
+    finally:
+        # Don't leave FFmpeg running if the conversion task was cancelled
+        if process and process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+        # Stop the stderr reader if we bailed out before it finished
+        if stderr_task and not stderr_task.done():
+            stderr_task.cancel()
+            try:
+                await stderr_task
+            except asyncio.CancelledError:
+                pass
+
+
+def convert_video_sync(
+    input_file: str,
+    output_file: str,
+    progress_callback: Optional[Callable[[Dict], None]] = None,
+    **kwargs
+) -> bool:
+    """Blocking wrapper around convert_video for non-async callers"""
+    return asyncio.run(convert_video(input_file, output_file, progress_callback, **kwargs))
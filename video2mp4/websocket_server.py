@@ -1,13 +1,26 @@
 """WebSocket server for real-time progress updates"""
 
 import asyncio
+import base64
 import json
+import aiofiles
+import aiofiles.os
 import websockets
 import logging
 import os
-from typing import Dict, Set, Optional
+import struct
+from typing import Dict, List, Set, Optional, Tuple, Union
 from .core import convert_video
 
+# Use orjson for outgoing messages when it is installed
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _dumps = json.dumps
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -15,16 +28,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Upload chunks are queued to a per-upload writer task and coalesced
+# into writes of at least this many bytes
+UPLOAD_QUEUE_SIZE = 16
+UPLOAD_WRITE_BUFFER = 2 * 1024 * 1024
+
+# Binary upload frames start with a big-endian upload slot (uint32) and
+# byte offset (uint64), followed by the raw chunk bytes
+UPLOAD_FRAME_HEADER = struct.Struct(">IQ")
+
+
+def _parse_upload_frame(message: bytes) -> Optional[Tuple[int, int, bytes]]:
+    """Split a binary upload frame into (upload_slot, offset, chunk); None if too short"""
+    if len(message) < UPLOAD_FRAME_HEADER.size:
+        return None
+    upload_slot, offset = UPLOAD_FRAME_HEADER.unpack_from(message)
+    return upload_slot, offset, message[UPLOAD_FRAME_HEADER.size:]
+
 
 class WebSocketServer:
     """WebSocket server for video conversion progress updates"""
 
-    def __init__(self, host: str = "localhost", port: int = 8765):
+    def __init__(self, host: str = "localhost", port: int = 8765, max_concurrent: Optional[int] = None):
         self.host = host
         self.port = port
+        # Bound concurrent FFmpeg processes; extra requests wait their turn.
+        # The semaphore is created on first use so it binds to the running loop
+        if max_concurrent is None:
+            max_concurrent = max(1, (os.cpu_count() or 2) // 2)
+        self.max_concurrent = max_concurrent
+        self.convert_sem: Optional[asyncio.Semaphore] = None
         self.active_connections: Set[websockets.WebSocketServerProtocol] = set()
-        self.tasks: Dict[str, asyncio.Task] = {}
+        self.tasks: Dict[str, Dict] = {}  # task_id -> {"task", "websocket"}
         self.uploads: Dict[str, Dict] = {}  # 存储上传状态
+        self.upload_slots: List[Optional[str]] = []  # 二进制分块的上传槽位 -> upload_id
+        # Monotonic counters so task/upload IDs are never reused
+        self._next_task_id = 0
+        self._next_upload_id = 0
         self.upload_dir = "uploads"  # 上传文件存储目录
         # 创建上传目录
         if not os.path.exists(self.upload_dir):
@@ -45,10 +85,19 @@ class WebSocketServer:
         finally:
             if websocket in self.active_connections:
                 self.active_connections.remove(websocket)
+            # Abandon any uploads this connection left unfinished
+            for upload_id in [uid for uid, state in self.uploads.items() if state["websocket"] is websocket]:
+                logger.info(f"Discarding unfinished upload {upload_id}")
+                await self._discard_upload(upload_id, remove_file=True)
 
-    async def process_message(self, websocket: websockets.WebSocketServerProtocol, message: str):
+    async def process_message(self, websocket: websockets.WebSocketServerProtocol, message: Union[str, bytes]):
         """Process incoming WebSocket messages"""
         try:
+            # Binary frames carry upload chunk data; everything else is JSON
+            if isinstance(message, bytes):
+                await self.handle_upload_binary(websocket, message)
+                return
+
             data = json.loads(message)
             action = data.get("action")
             logger.debug(f"Received message from {websocket.remote_address}: {action}")
@@ -68,21 +117,21 @@ class WebSocketServer:
             else:
                 error_msg = f"Unknown action: {action}"
                 logger.warning(error_msg)
-                await websocket.send(json.dumps({
+                await websocket.send(_dumps({
                     "type": "error",
                     "message": error_msg
                 }))
         except json.JSONDecodeError:
             error_msg = "Invalid JSON format"
             logger.warning(f"Invalid JSON from {websocket.remote_address}")
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": error_msg
             }))
         except Exception as e:
             error_msg = str(e)
             logger.error(f"Error processing message from {websocket.remote_address}: {error_msg}")
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": error_msg
             }))
@@ -91,7 +140,7 @@ class WebSocketServer:
         """Handle FFmpeg check request"""
         from .core import check_ffmpeg
         is_available = check_ffmpeg()
-        await websocket.send(json.dumps({
+        await websocket.send(_dumps({
             "type": "ffmpeg_check",
             "available": is_available,
             "message": "FFmpeg is available" if is_available else "FFmpeg is not installed or not in PATH"
@@ -104,18 +153,19 @@ class WebSocketServer:
         options = data.get("options", {})
 
         if not input_file or not output_file:
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": "Missing input_file or output_file"
             }))
             return
 
-        task_id = f"{id(websocket)}_{len(self.tasks)}"
+        self._next_task_id += 1
+        task_id = str(self._next_task_id)
         
         async def progress_callback(update: Dict):
             """Callback to send progress updates via WebSocket"""
             try:
-                await websocket.send(json.dumps({
+                await websocket.send(_dumps({
                     "type": "progress",
                     "task_id": task_id,
                     **update
@@ -123,146 +173,236 @@ class WebSocketServer:
             except websockets.ConnectionClosed:
                 pass
 
-        # Create and start conversion task
+        # Create and start conversion task. self.tasks holds only in-flight
+        # conversions, so its size tells whether this one must wait for a slot
+        # (convert_sem.locked() misses tasks that haven't started running yet)
+        queued = len(self.tasks) >= self.max_concurrent
         task = asyncio.create_task(
             self.run_conversion(input_file, output_file, progress_callback, options)
         )
-        self.tasks[task_id] = task
+        self.tasks[task_id] = {"task": task, "websocket": websocket}
+        # Forget the task once it finishes so self.tasks doesn't grow unbounded
+        task.add_done_callback(lambda t, tid=task_id: self.tasks.pop(tid, None))
 
         # Send task ID to client
-        await websocket.send(json.dumps({
+        await websocket.send(_dumps({
             "type": "task_started",
             "task_id": task_id,
             "message": "Conversion task started"
         }))
 
+        if queued:
+            await websocket.send(_dumps({
+                "type": "queued",
+                "task_id": task_id,
+                "message": "Waiting for a free conversion slot"
+            }))
+
     async def run_conversion(self, input_file: str, output_file: str, callback, options: Dict):
         """Run video conversion in a separate task"""
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None,
-            lambda: convert_video(input_file, output_file, callback, **options)
-        )
-        return result
+        if self.convert_sem is None:
+            self.convert_sem = asyncio.Semaphore(self.max_concurrent)
+        async with self.convert_sem:
+            return await convert_video(input_file, output_file, callback, **options)
 
     async def handle_cancel_request(self, websocket: websockets.WebSocketServerProtocol, data: Dict):
         """Handle conversion cancellation request"""
         task_id = data.get("task_id")
-        if task_id in self.tasks:
-            task = self.tasks.pop(task_id)
+        # Task IDs are guessable, so only the connection that started a task may cancel it
+        if self._owns_task(websocket, task_id):
+            task = self.tasks.pop(task_id)["task"]
             task.cancel()
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "task_cancelled",
                 "task_id": task_id,
                 "message": "Conversion task cancelled"
             }))
         else:
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": f"Task {task_id} not found"
             }))
 
+    def _owns_task(self, websocket: websockets.WebSocketServerProtocol, task_id: Optional[str]) -> bool:
+        """Check that a conversion task exists and was started by this connection"""
+        return task_id in self.tasks and self.tasks[task_id]["websocket"] is websocket
+
     async def handle_upload(self, websocket: websockets.WebSocketServerProtocol, data: Dict):
         """Handle file upload initialization"""
         file_name = data.get("file_name")
         file_size = data.get("file_size", 0)
         
         if not file_name:
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": "Missing file_name"
             }))
             return
         
         # Generate unique upload ID
-        upload_id = f"{id(websocket)}_{len(self.uploads)}"
+        self._next_upload_id += 1
+        upload_id = str(self._next_upload_id)
         file_path = os.path.join(self.upload_dir, file_name)
         
+        # Reuse a free binary upload slot, or add a new one
+        try:
+            upload_slot = self.upload_slots.index(None)
+            self.upload_slots[upload_slot] = upload_id
+        except ValueError:
+            upload_slot = len(self.upload_slots)
+            self.upload_slots.append(upload_id)
+
         # Initialize upload state
         self.uploads[upload_id] = {
+            "websocket": websocket,
+            "upload_slot": upload_slot,
             "file_name": file_name,
             "file_path": file_path,
             "file_size": file_size,
-            "uploaded_size": 0,
-            "file_handle": None
+            "uploaded_size": 0,  # bytes written to the file
+            "received_size": 0,  # bytes accepted from the client
+            "file_handle": None,
+            "queue": None,
+            "writer_task": None,
+            "error": None
         }
         
         # Create file for writing
         try:
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            # Ensure directory exists (off the event loop; may be a slow filesystem)
+            await aiofiles.os.makedirs(os.path.dirname(file_path), exist_ok=True)
             # Open file in binary write mode
-            file_handle = open(file_path, 'wb')
+            file_handle = await aiofiles.open(file_path, 'wb')
             self.uploads[upload_id]["file_handle"] = file_handle
+            # Start the writer task that drains this upload's chunk queue
+            queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+            self.uploads[upload_id]["queue"] = queue
+            self.uploads[upload_id]["writer_task"] = asyncio.create_task(
+                self._upload_writer(upload_id, queue)
+            )
             
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "upload_init",
                 "upload_id": upload_id,
+                "upload_slot": upload_slot,
                 "message": "Upload initialized successfully"
             }))
         except Exception as e:
             logger.error(f"Error initializing upload: {e}")
-            await websocket.send(json.dumps({
+            await self._discard_upload(upload_id)
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": f"Failed to initialize upload: {str(e)}"
             }))
 
     async def handle_upload_chunk(self, websocket: websockets.WebSocketServerProtocol, data: Dict):
-        """Handle file chunk upload"""
+        """Handle base64-encoded file chunk upload"""
         upload_id = data.get("upload_id")
         chunk = data.get("chunk")
-        offset = data.get("offset", 0)
+        offset = data.get("offset")
         
         if not upload_id or not chunk:
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": "Missing upload_id or chunk"
             }))
             return
         
-        if upload_id not in self.uploads:
-            await websocket.send(json.dumps({
+        try:
+            # Decode on a worker thread, then hand the bytes to the writer task
+            loop = asyncio.get_running_loop()
+            chunk_data = await loop.run_in_executor(None, base64.b64decode, chunk)
+        except Exception as e:
+            logger.error(f"Error handling upload chunk: {e}")
+            await websocket.send(_dumps({
+                "type": "error",
+                "message": f"Failed to process upload chunk: {str(e)}"
+            }))
+            return
+
+        await self._queue_upload_chunk(websocket, upload_id, chunk_data, offset)
+
+    async def handle_upload_binary(self, websocket: websockets.WebSocketServerProtocol, message: bytes):
+        """Handle raw file chunk upload sent as a binary frame"""
+        frame = _parse_upload_frame(message)
+        if frame is None:
+            await websocket.send(_dumps({
+                "type": "error",
+                "message": "Binary upload frame is too short"
+            }))
+            return
+
+        upload_slot, offset, chunk_data = frame
+        upload_id = self.upload_slots[upload_slot] if upload_slot < len(self.upload_slots) else None
+
+        if not self._owns_upload(websocket, upload_id):
+            await websocket.send(_dumps({
+                "type": "error",
+                "message": f"Upload slot {upload_slot} not found"
+            }))
+            return
+
+        await self._queue_upload_chunk(websocket, upload_id, chunk_data, offset)
+
+    def _owns_upload(self, websocket: websockets.WebSocketServerProtocol, upload_id: Optional[str]) -> bool:
+        """Check that an upload exists and was started by this connection"""
+        return upload_id in self.uploads and self.uploads[upload_id]["websocket"] is websocket
+
+    async def _queue_upload_chunk(
+        self,
+        websocket: websockets.WebSocketServerProtocol,
+        upload_id: str,
+        chunk_data: bytes,
+        offset: Optional[int] = None
+    ):
+        """Queue decoded chunk bytes for an upload's writer task"""
+        if not self._owns_upload(websocket, upload_id):
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": f"Upload {upload_id} not found"
             }))
             return
         
         upload_state = self.uploads[upload_id]
-        file_handle = upload_state.get("file_handle")
+        queue = upload_state.get("queue")
         
-        if not file_handle:
-            await websocket.send(json.dumps({
+        if not queue:
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": "Upload not properly initialized"
             }))
             return
         
+        # Chunks are appended in order, so a duplicate or out-of-order one would corrupt the file
+        if offset is not None and offset != upload_state["received_size"]:
+            await websocket.send(_dumps({
+                "type": "error",
+                "message": f"Unexpected upload offset {offset} for upload {upload_id}, expected {upload_state['received_size']}"
+            }))
+            return
+        
         try:
-            # Convert base64 chunk to bytes
-            import base64
-            chunk_data = base64.b64decode(chunk)
-            
-            # Write chunk to file
-            file_handle.write(chunk_data)
-            
-            # Update uploaded size
-            upload_state["uploaded_size"] += len(chunk_data)
+            if upload_state["error"]:
+                raise upload_state["error"]
+
+            await queue.put(chunk_data)
+            upload_state["received_size"] += len(chunk_data)
             
-            # Calculate progress
-            file_size = upload_state.get("file_size", 1)
-            progress = min(100, int((upload_state["uploaded_size"] / file_size) * 100))
+            # Report bytes accepted; the writer task may still be buffering them
+            file_size = upload_state.get("file_size") or 1
+            progress = min(100, int((upload_state["received_size"] / file_size) * 100))
             
             # Send progress update
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "upload_progress",
                 "upload_id": upload_id,
                 "progress": progress,
-                "uploaded": upload_state["uploaded_size"],
+                "uploaded": upload_state["received_size"],
                 "total": file_size
             }))
         except Exception as e:
             logger.error(f"Error handling upload chunk: {e}")
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": f"Failed to process upload chunk: {str(e)}"
             }))
@@ -272,14 +412,14 @@ class WebSocketServer:
         upload_id = data.get("upload_id")
         
         if not upload_id:
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": "Missing upload_id"
             }))
             return
         
-        if upload_id not in self.uploads:
-            await websocket.send(json.dumps({
+        if not self._owns_upload(websocket, upload_id):
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": f"Upload {upload_id} not found"
             }))
@@ -287,20 +427,33 @@ class WebSocketServer:
         
         upload_state = self.uploads[upload_id]
         file_handle = upload_state.get("file_handle")
+        writer_task = upload_state.get("writer_task")
         
         try:
+            # Flush queued chunks and wait for the writer to finish
+            if writer_task:
+                await upload_state["queue"].put(None)
+                await writer_task
+                if upload_state["error"]:
+                    raise upload_state["error"]
+
             # Close file handle if open
             if file_handle:
-                file_handle.close()
+                await file_handle.close()
                 upload_state["file_handle"] = None
             
             # Get file path
             file_path = upload_state.get("file_path")
             file_name = upload_state.get("file_name")
             
-            # Verify file exists and has content
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                await websocket.send(json.dumps({
+            # Verify file exists and has content with a single stat call
+            try:
+                has_content = os.stat(file_path).st_size > 0
+            except FileNotFoundError:
+                has_content = False
+
+            if has_content:
+                await websocket.send(_dumps({
                     "type": "upload_complete",
                     "upload_id": upload_id,
                     "file_path": file_path,
@@ -308,41 +461,95 @@ class WebSocketServer:
                     "message": "File uploaded successfully"
                 }))
             else:
-                await websocket.send(json.dumps({
+                await websocket.send(_dumps({
                     "type": "error",
                     "message": "Uploaded file is empty or does not exist"
                 }))
         except Exception as e:
             logger.error(f"Error completing upload: {e}")
-            await websocket.send(json.dumps({
+            await websocket.send(_dumps({
                 "type": "error",
                 "message": f"Failed to complete upload: {str(e)}"
             }))
         finally:
             # Clean up upload state
-            if upload_id in self.uploads:
-                # Ensure file handle is closed
-                if self.uploads[upload_id].get("file_handle"):
-                    try:
-                        self.uploads[upload_id]["file_handle"].close()
-                    except:
-                        pass
-                del self.uploads[upload_id]
+            await self._discard_upload(upload_id)
+
+    async def _discard_upload(self, upload_id: str, remove_file: bool = False):
+        """Drop an upload's state, slot, writer task and file handle"""
+        upload_state = self.uploads.pop(upload_id, None)
+        if upload_state is None:
+            return
+        self.upload_slots[upload_state["upload_slot"]] = None
+
+        writer_task = upload_state.get("writer_task")
+        if writer_task and not writer_task.done():
+            writer_task.cancel()
+            try:
+                await writer_task
+            except asyncio.CancelledError:
+                pass
+
+        # Ensure file handle is closed
+        if upload_state.get("file_handle"):
+            try:
+                await upload_state["file_handle"].close()
+            except Exception:
+                pass
+
+        # Partial uploads are useless; don't leave them behind
+        if remove_file:
+            try:
+                await aiofiles.os.remove(upload_state["file_path"])
+            except OSError:
+                pass
+
+    async def _upload_writer(self, upload_id: str, queue: asyncio.Queue):
+        """Drain an upload's chunk queue into its file, coalescing small chunks"""
+        upload_state = self.uploads[upload_id]
+        file_handle = upload_state["file_handle"]
+        buffer = bytearray()
+        while True:
+            chunk = await queue.get()
+            # After a failed write keep draining so producers never block
+            if upload_state["error"]:
+                if chunk is None:
+                    return
+                continue
+            try:
+                if chunk is not None:
+                    buffer += chunk
+                if buffer and (chunk is None or len(buffer) >= UPLOAD_WRITE_BUFFER):
+                    await file_handle.write(bytes(buffer))
+                    upload_state["uploaded_size"] += len(buffer)
+                    buffer.clear()
+            except Exception as e:
+                logger.error(f"Error writing upload {upload_id}: {e}")
+                upload_state["error"] = e
+                buffer.clear()
+            if chunk is None:
+                return
 
     async def broadcast(self, message: Dict):
         """Broadcast message to all connected clients"""
         if self.active_connections:
-            message_json = json.dumps(message)
+            message_json = _dumps(message)
+            # Send to every client concurrently so one slow client can't delay the rest
+            connections = list(self.active_connections)
+            results = await asyncio.gather(
+                *(connection.send(message_json) for connection in connections),
+                return_exceptions=True
+            )
             disconnected = []
-            for connection in self.active_connections:
-                try:
-                    await connection.send(message_json)
-                except websockets.ConnectionClosed:
+            for connection, result in zip(connections, results):
+                if isinstance(result, websockets.ConnectionClosed):
                     disconnected.append(connection)
+                elif isinstance(result, Exception):
+                    logger.error(f"Error broadcasting to {connection.remote_address}: {result}")
 
             # Remove disconnected clients
             for connection in disconnected:
-                self.active_connections.remove(connection)
+                self.active_connections.discard(connection)
 
     async def start(self):
         """Start the WebSocket server"""
@@ -356,9 +563,9 @@ class WebSocketServer:
             await server.serve_forever()
 
 
-def start_server(host: str = "localhost", port: int = 8765):
+def start_server(host: str = "localhost", port: int = 8765, max_concurrent: Optional[int] = None):
     """Start the WebSocket server"""
-    server = WebSocketServer(host, port)
+    server = WebSocketServer(host, port, max_concurrent)
     asyncio.run(server.start())
 
 